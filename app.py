@@ -1,10 +1,13 @@
+import hmac
 import logging
 import os
-import threading
+import uuid
 from functools import wraps
 
 from flask import Flask, jsonify, request
 from get_data.get_data import run_data_collection
+from redis import Redis
+from rq import Queue
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
@@ -12,6 +15,12 @@ app = Flask(__name__)
 # --- Configuration ---
 # 從環境變數獲取 Webhook Token，如果未設定則使用一個預設值（建議在生產環境中設定）
 WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN", "default-secret-token")
+# 預先計算完整的 Authorization header，驗證時以常數時間比較
+_EXPECTED_AUTH_HEADER = b"Bearer " + WEBHOOK_TOKEN.encode()
+# 任務佇列使用的 Redis 連線字串
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# 單次資料抓取任務的最長執行時間（秒），同時作為任務鎖的存活時間
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", 3600))
 
 # --- Logging Setup ---
 # 讓日誌輸出到 console，方便在 Zeabur 後台查看
@@ -30,14 +39,9 @@ def require_token(f):
             logging.warning("Webhook: 缺少 Authorization header。")
             return jsonify({"error": "Missing authorization token"}), 401
 
-        try:
-            auth_type, token = auth_header.split()
-            if auth_type.lower() != "bearer" or token != WEBHOOK_TOKEN:
-                logging.warning("Webhook: 無效的 Token。")
-                return jsonify({"error": "Invalid token"}), 401
-        except ValueError:
-            logging.warning("Webhook: Authorization header 格式錯誤。")
-            return jsonify({"error": "Invalid authorization header format"}), 401
+        if not hmac.compare_digest(auth_header.encode(), _EXPECTED_AUTH_HEADER):
+            logging.warning("Webhook: 無效的 Token。")
+            return jsonify({"error": "Invalid token"}), 401
 
         return f(*args, **kwargs)
 
@@ -45,23 +49,50 @@ def require_token(f):
 
 
 # --- Webhook Task Management ---
-# 使用一個全域變數來追蹤任務是否正在執行，防止重複觸發
-task_running = False
-task_lock = threading.Lock()
+# 任務交由 RQ worker 執行；以 Redis 中的鎖（SET NX + TTL）防止重複觸發，
+# 讓多個 gunicorn worker 或多個服務實例共享同一個任務狀態。
+# 鎖的值為該任務的 job id，只有持有者可以延長或釋放它。
+TASK_QUEUE_NAME = "stock_ai"
+TASK_LOCK_KEY = "stock_ai:data_collection:running"
+
+redis_conn = Redis.from_url(REDIS_URL)
+task_queue = Queue(TASK_QUEUE_NAME, connection=redis_conn)
+
+# 若鎖仍屬於此任務（或已因排隊過久而過期），重新取得鎖並重設 TTL
+_claim_task_lock = redis_conn.register_script("""
+local current = redis.call('GET', KEYS[1])
+if current == ARGV[1] or not current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+""")
+
+# 只在鎖仍屬於此任務時刪除，避免釋放之後任務取得的鎖
+_release_task_lock = redis_conn.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def run_task_in_background(lock_token):
+    """在 RQ worker 中執行資料收集任務，並在完成後釋放任務鎖。"""
+    # 鎖的 TTL 從加入佇列時開始計算，開始執行時重設，讓它涵蓋完整的 job_timeout
+    if not _claim_task_lock(keys=[TASK_LOCK_KEY], args=[lock_token, JOB_TIMEOUT]):
+        logging.warning("另一個資料抓取任務已持有任務鎖，略過此任務。")
+        return
 
-
-def run_task_in_background():
-    """在背景執行資料收集任務，並在完成後重設 flag。"""
-    global task_running
     try:
         logging.info("開始執行背景資料抓取任務...")
         run_data_collection()
         logging.info("背景資料抓取任務完成。")
     except Exception as e:
         logging.error(f"背景任務執行失敗: {e}")
+        raise
     finally:
-        with task_lock:
-            task_running = False
+        _release_task_lock(keys=[TASK_LOCK_KEY], args=[lock_token])
 
 
 # --- Flask Routes ---
@@ -79,19 +110,20 @@ def webhook_trigger():
     - 需要在 Header 中提供 'Authorization: Bearer <YOUR_TOKEN>'。
     - 如果已有任務在執行，會回傳 429 Too Many Requests。
     """
-    global task_running
-    with task_lock:
-        if task_running:
-            logging.warning("Webhook 觸發，但已有任務正在執行。")
-            return jsonify({"status": "error", "message": "A task is already running. Please try again later."}), 429
-        task_running = True
-
-    # 在背景執行緒中啟動資料抓取任務
-    thread = threading.Thread(target=run_task_in_background)
-    thread.start()
-
-    logging.info("Webhook 成功觸發，資料抓取任務已在背景開始。")
-    return jsonify({"status": "success", "message": "Task accepted and is running in the background."}), 202
+    job_id = uuid.uuid4().hex
+    if not redis_conn.set(TASK_LOCK_KEY, job_id, nx=True, ex=JOB_TIMEOUT):
+        logging.warning("Webhook 觸發，但已有任務正在執行。")
+        return jsonify({"status": "error", "message": "A task is already running. Please try again later."}), 429
+
+    # 將資料抓取任務放入佇列，由 RQ worker 在背景執行
+    try:
+        job = task_queue.enqueue(run_task_in_background, job_id, job_id=job_id, job_timeout=JOB_TIMEOUT)
+    except Exception:
+        _release_task_lock(keys=[TASK_LOCK_KEY], args=[job_id])
+        raise
+
+    logging.info("Webhook 成功觸發，資料抓取任務已加入佇列 (job id: %s)。", job.id)
+    return jsonify({"status": "success", "message": "Task accepted and is running in the background.", "job_id": job.id}), 202
 
 
 if __name__ == "__main__":
@@ -3,13 +3,17 @@ This script fetches historical stock data from Yahoo Finance and stores it in a
 
 It downloads data for all tickers from S&P 500, Dow Jones, NASDAQ, and selected ETFs.
 The script supports incremental updates to avoid re-downloading existing data.
-Each ticker's data is saved in a separate table in the database.
+All tickers' data is saved in a single `prices` table keyed by (ticker, Date).
 """
 import logging
 import os
 import re
+import tempfile
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
 import yfinance as yf
 from dotenv import load_dotenv
@@ -29,11 +33,36 @@ DB_NAME = os.getenv("SQL_DATABASE")
 # 資料庫連接字串
 DATABASE_URL = f"mysql+mysqlconnector://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# 尚無資料的 ticker 的起始抓取日期
+DEFAULT_START_DATE = "1950-01-01"
+# 每次 yf.download 呼叫最多包含的 ticker 數量
+DOWNLOAD_BATCH_SIZE = 200
+# 所有 ticker 共用的歷史價格表格與其分割區數量
+PRICES_TABLE = "prices"
+PRICES_PARTITIONS = 64
+# 寫入資料庫時每個多列 INSERT 語句包含的列數
+INSERT_CHUNK_SIZE = 1000
+# 資料列數達到此門檻時改用 LOAD DATA LOCAL INFILE 寫入
+LOAD_DATA_MIN_ROWS = 5000
+# 寫入資料庫的價格欄位
+PRICE_COLUMNS = ['ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+# 同時寫入資料庫的執行緒數量（需小於 SQLAlchemy 連線池上限 15）
+WRITE_WORKERS = 4
+# 伺服器拒絕 LOAD DATA LOCAL INFILE 後設為 True，本次執行的其餘批次直接改用 executemany
+load_data_disabled = False
+# 合法的 ticker 格式：大寫字母，可包含 '-' 或 '.'
+TICKER_PATTERN = re.compile(r"[A-Z.\-]+")
+# 記錄每個 ticker 最新資料日期與下次最早抓取時間的表格
+WATERMARK_TABLE = "_ticker_watermarks"
+# 同一個 ticker 兩次抓取之間的最短間隔
+MIN_FETCH_INTERVAL = timedelta(hours=1)
+
 
 def get_db_engine():
     """創建並返回一個 SQLAlchemy 資料庫引擎。"""
     try:
-        engine = create_engine(DATABASE_URL)
+        # 只允許 LOAD DATA LOCAL INFILE 讀取暫存目錄中的檔案
+        engine = create_engine(DATABASE_URL, connect_args={"allow_local_infile_in_path": tempfile.gettempdir()})
         # 測試連接
         with engine.connect() as connection:
             logging.info("資料庫連接成功！")
@@ -75,63 +104,379 @@ def fetch_all_tickers():
     except Exception as e:
         logging.error("Failed to fetch ETF tickers: %s", e)
 
-    # Use a set to get unique tickers, then sort
-    unique_tickers = sorted(list(set(tickers)))
-    # Filter for valid ticker formats (usually uppercase letters, can contain '-' or '.')
-    valid_tickers = [t for t in unique_tickers if re.search(r"^[A-Z-.]+$", t) and len(t) <= 64]  # MySQL table name length limit
+    # Deduplicate in one order-preserving pass and filter for valid ticker formats
+    # (usually uppercase letters, can contain '-' or '.'), then sort the survivors once
+    valid_tickers = [
+        t for t in dict.fromkeys(tickers)
+        if len(t) <= 64 and TICKER_PATTERN.fullmatch(t)  # prices.ticker column length limit
+    ]
+    valid_tickers.sort()
     logging.info("Found %d unique, valid tickers for DB.", len(valid_tickers))
     return valid_tickers
 
 
+def get_table_name(ticker):
+    """Sanitizes a ticker into the name of its legacy per-ticker MySQL table."""
+    return ticker.replace('.', '_').replace('-', '_')
+
+
+def ensure_prices_table(engine):
+    """Creates the partitioned prices table if it does not exist yet."""
+    with engine.begin() as connection:
+        if engine.dialect.has_table(connection, PRICES_TABLE):
+            return
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS `{PRICES_TABLE}` ("
+            "`ticker` VARCHAR(64) NOT NULL, "
+            "`Date` DATE NOT NULL, "
+            "`Open` DOUBLE, `High` DOUBLE, `Low` DOUBLE, `Close` DOUBLE, `Volume` BIGINT, "
+            "`Dividends` DOUBLE, `Stock Splits` DOUBLE, "
+            "PRIMARY KEY (`ticker`, `Date`)) "
+            f"PARTITION BY KEY(`ticker`) PARTITIONS {PRICES_PARTITIONS}"
+        ))
+    logging.info("Created table `%s`.", PRICES_TABLE)
+
+
+def migrate_legacy_tables(engine, ticker_list):
+    """
+    Copies rows from the old one-table-per-ticker layout into the prices table,
+    so existing history does not have to be downloaded again.
+
+    Only tickers that have no rows in prices yet are copied, and each ticker is copied
+    in its own transaction, so a run that is interrupted part-way resumes on the next run.
+    Legacy tables created without the Dividends / Stock Splits columns copy NULLs.
+    """
+    migrated_tickers = fetch_last_dates(engine)
+    with engine.connect() as connection:
+        query = text("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+        existing_tables = set(connection.execute(query).scalars())
+        query = text(
+            "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME IN ('Dividends', 'Stock Splits')"
+        )
+        action_columns = set(connection.execute(query).tuples())
+
+    legacy_tickers = [
+        t for t in ticker_list if t not in migrated_tickers and get_table_name(t) in existing_tables
+    ]
+    if not legacy_tickers:
+        return
+    logging.info("Migrating %d legacy ticker tables into `%s`...", len(legacy_tickers), PRICES_TABLE)
+
+    for ticker in tqdm(legacy_tickers, desc="Migrating Legacy Tables"):
+        table_name = get_table_name(ticker)
+        action_selects = ", ".join(
+            f"`{col}`" if (table_name, col) in action_columns else "NULL"
+            for col in ['Dividends', 'Stock Splits']
+        )
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"INSERT IGNORE INTO `{PRICES_TABLE}` "
+                    "(`ticker`, `Date`, `Open`, `High`, `Low`, `Close`, `Volume`, `Dividends`, `Stock Splits`) "
+                    f"SELECT :ticker, `Date`, `Open`, `High`, `Low`, `Close`, `Volume`, {action_selects} "
+                    f"FROM `{table_name}`"
+                ), {'ticker': ticker})
+        except Exception as e:
+            logging.error("[%s] Failed to migrate legacy table: %s", ticker, e)
+
+
+def fetch_last_dates(engine):
+    """Returns a dict mapping each ticker in the prices table to its latest stored Date."""
+    with engine.connect() as connection:
+        rows = connection.execute(text(f"SELECT `ticker`, MAX(`Date`) FROM `{PRICES_TABLE}` GROUP BY `ticker`"))
+        last_dates = {}
+        for ticker, last_date in rows:
+            if isinstance(last_date, str):
+                last_date = datetime.strptime(str(last_date), '%Y-%m-%d').date()
+            elif isinstance(last_date, datetime):
+                last_date = last_date.date()
+            last_dates[ticker] = last_date
+
+    logging.info("Found existing data for %d tickers.", len(last_dates))
+    return last_dates
+
+
+def get_start_date(last_dates, ticker):
+    """
+    Returns the first date to fetch for a ticker: the day after its latest stored Date,
+    or DEFAULT_START_DATE if it has no data yet.
+    """
+    last_date = last_dates.get(ticker)
+    if last_date is None:
+        return DEFAULT_START_DATE
+    return (last_date + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def fetch_watermarks(engine):
+    """
+    Creates the watermark table if needed and returns a dict mapping each ticker
+    to its next_earliest_fetch time.
+    """
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS `{WATERMARK_TABLE}` ("
+            "ticker VARCHAR(64) NOT NULL PRIMARY KEY, "
+            "last_date DATE NULL, "
+            "next_earliest_fetch DATETIME NOT NULL)"
+        ))
+        rows = connection.execute(text(f"SELECT ticker, next_earliest_fetch FROM `{WATERMARK_TABLE}`"))
+        return {ticker: next_earliest_fetch for ticker, next_earliest_fetch in rows}
+
+
+def update_watermarks(engine, watermarks):
+    """
+    Upserts watermark rows, given as dicts with ticker, last_date and next_earliest_fetch.
+
+    A last_date of None keeps the stored last_date and only pushes back the next fetch time.
+    """
+    if not watermarks:
+        return
+    query = text(
+        f"INSERT INTO `{WATERMARK_TABLE}` (ticker, last_date, next_earliest_fetch) "
+        "VALUES (:ticker, :last_date, :next_earliest_fetch) "
+        "ON DUPLICATE KEY UPDATE "
+        "last_date = COALESCE(VALUES(last_date), last_date), "
+        "next_earliest_fetch = VALUES(next_earliest_fetch)"
+    )
+    with engine.begin() as connection:
+        connection.execute(query, watermarks)
+
+
+def get_next_fetch_time(last_date):
+    """
+    Returns the earliest time a ticker is worth fetching again: the next business day
+    after last_date, but never sooner than MIN_FETCH_INTERVAL from now.
+    """
+    earliest = datetime.now() + MIN_FETCH_INTERVAL
+    if last_date is None:
+        return earliest
+    next_business_day = (pd.Timestamp(last_date) + pd.offsets.BDay(1)).to_pydatetime()
+    return max(next_business_day, earliest)
+
+
+def extract_ticker_data(df_batch, ticker):
+    """
+    Extracts one ticker's rows from a yf.download result.
+
+    With more than one ticker, yf.download returns (ticker, field) MultiIndex columns;
+    with a single ticker the columns are flat. Dates on which the ticker has no data are
+    all-NaN rows in the combined frame and are dropped.
+    """
+    if isinstance(df_batch.columns, pd.MultiIndex):
+        if ticker not in df_batch.columns.get_level_values(0):
+            return pd.DataFrame()
+        df_batch = df_batch[ticker]
+    return df_batch.dropna(how='all')
+
+
+def upsert_prices(engine, df):
+    """
+    Upserts the PRICE_COLUMNS of df into the prices table through a raw DB-API cursor.
+
+    Bypasses pandas' to_sql, which rebuilds its SQLTable and INSERT on every call; the
+    INSERT is built once and mysql-connector's executemany sends each chunk of plain
+    tuples as a single multi-row statement. Rows are converted to tuples one chunk at a
+    time so a large batch is never held in memory as Python objects all at once. Rows
+    already stored for a (ticker, Date) are overwritten.
+    """
+    df = df.reindex(columns=PRICE_COLUMNS)
+
+    column_list = ", ".join(f"`{col}`" for col in PRICE_COLUMNS)
+    placeholders = ", ".join(["%s"] * len(PRICE_COLUMNS))
+    updates = ", ".join(f"`{col}` = VALUES(`{col}`)" for col in PRICE_COLUMNS[2:])
+    upsert_sql = (
+        f"INSERT INTO `{PRICES_TABLE}` ({column_list}) VALUES ({placeholders}) "
+        f"ON DUPLICATE KEY UPDATE {updates}"
+    )
+
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        for i in range(0, len(df), INSERT_CHUNK_SIZE):
+            chunk = df.iloc[i:i + INSERT_CHUNK_SIZE]
+            rows = list(chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None))
+            cursor.executemany(upsert_sql, rows)
+        raw_connection.commit()
+        cursor.close()
+    finally:
+        raw_connection.close()
+
+
+def load_prices(engine, df):
+    """
+    Bulk-loads the PRICE_COLUMNS of df into the prices table with LOAD DATA LOCAL INFILE.
+
+    The rows are written to a temporary TSV file and streamed in one statement, skipping
+    per-row SQL parsing. Rows already stored for a (ticker, Date) are replaced, matching
+    upsert_prices.
+    """
+    df = df.reindex(columns=PRICE_COLUMNS)
+    column_list = ", ".join(f"`{col}`" for col in PRICE_COLUMNS)
+    load_sql = (
+        f"LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE `{PRICES_TABLE}` "
+        f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({column_list})"
+    )
+
+    tsv_file = tempfile.NamedTemporaryFile('w', suffix='.tsv', newline='', delete=False)
+    try:
+        with tsv_file:
+            df.to_csv(tsv_file, sep='\t', header=False, index=False, na_rep='\\N', lineterminator='\n')
+
+        raw_connection = engine.raw_connection()
+        try:
+            cursor = raw_connection.cursor()
+            cursor.execute(load_sql, (tsv_file.name,))
+            raw_connection.commit()
+            cursor.close()
+        finally:
+            raw_connection.close()
+    finally:
+        os.remove(tsv_file.name)
+
+
+def format_dates(dates):
+    """Formats a datetime-like Series as an array of 'YYYY-MM-DD' strings."""
+    return np.datetime_as_string(pd.to_datetime(dates).to_numpy(dtype='datetime64[D]'), unit='D')
+
+
+def save_batch_data(engine, frames):
+    """
+    Saves the new rows of one download batch with a single upsert and advances
+    the watermarks of its tickers. Runs on a write-pool thread.
+
+    Args:
+        engine: SQLAlchemy database engine.
+        frames (dict): Maps each ticker to its non-empty DataFrame of new rows.
+    """
+    try:
+        df_all = pd.concat(frames, names=['ticker']).reset_index()
+        # Ensure correct data types for DB. Dates are formatted straight from datetime64 to
+        # 'YYYY-MM-DD' strings in one numpy call instead of building a datetime.date per row.
+        df_all['Date'] = format_dates(df_all['Date'])
+        for col in PRICE_COLUMNS[2:]:
+            if col in df_all.columns:
+                df_all[col] = pd.to_numeric(df_all[col])
+
+        # Write to database: large backfills are streamed with LOAD DATA, small daily
+        # appends go through executemany. Once the server rejects LOAD DATA, the rest of
+        # the run skips it instead of paying for a temp file and a failed round-trip.
+        global load_data_disabled
+        if len(df_all) >= LOAD_DATA_MIN_ROWS and not load_data_disabled:
+            try:
+                load_prices(engine, df_all)
+            except Exception as e:
+                load_data_disabled = True
+                logging.warning("LOAD DATA LOCAL INFILE failed, using executemany for the rest of this run: %s", e)
+                upsert_prices(engine, df_all)
+        else:
+            upsert_prices(engine, df_all)
+        logging.info("Saved/Appended %d records for %d tickers to table `%s`.", len(df_all), len(frames), PRICES_TABLE)
+
+        last_dates = df_all.groupby('ticker')['Date'].max()
+        update_watermarks(engine, [
+            {'ticker': ticker, 'last_date': last_date, 'next_earliest_fetch': get_next_fetch_time(last_date)}
+            for ticker, last_date in last_dates.items()
+        ])
+    except Exception as e:
+        logging.error("Failed to save batch of %d tickers: %s", len(frames), e)
+
+
 def fetch_historical_data(engine, ticker_list):
     """
     為指定的 ticker 列表獲取歷史市場數據，並支援增量更新到資料庫。
 
+    Tickers whose watermark says they are not due yet are skipped without contacting
+    Yahoo Finance. The rest are bucketed by start date and downloaded together in
+    batches of DOWNLOAD_BATCH_SIZE with a single threaded yf.download call.
+
     Args:
         engine: SQLAlchemy database engine.
         ticker_list (list): The list of stock tickers to fetch data for.
     """
     logging.info("Starting historical data fetch for %d tickers...", len(ticker_list))
 
-    for ticker in tqdm(ticker_list, desc="Fetching Historical Data to DB"):
-        table_name = ticker.replace('.', '_').replace('-', '_')  # Sanitize ticker for table name
-        start_date = "1950-01-01"
+    global load_data_disabled
+    load_data_disabled = False
 
-        try:
-            with engine.connect() as connection:
-                if engine.dialect.has_table(connection, table_name):
-                    query = text(f"SELECT MAX(Date) FROM `{table_name}`")
-                    result = connection.execute(query).scalar()
-                    if pd.notna(result):
-                        last_date = result
-                        if isinstance(last_date, str):
-                            last_date = datetime.strptime(str(last_date), '%Y-%m-%d').date()
-                        elif isinstance(last_date, datetime):
-                            last_date = last_date.date()
-
-                        start_date = (last_date + timedelta(days=1)).strftime('%Y-%m-%d')
-                        logging.debug("[%s] Existing data found. Fetching new data from %s.", ticker, start_date)
-
-            t_obj = yf.Ticker(ticker)
-            df_new = t_obj.history(start=start_date, auto_adjust=True)
-
-            if df_new.empty:
-                logging.info("[%s] No new data available since %s.", ticker, start_date)
+    try:
+        watermarks = fetch_watermarks(engine)
+    except Exception as e:
+        logging.error("Failed to read ticker watermarks, fetching all tickers: %s", e)
+        watermarks = {}
+
+    now = datetime.now()
+    due_tickers = [t for t in ticker_list if watermarks.get(t, now) <= now]
+    logging.info("Skipping %d tickers that are not due for a fetch yet.", len(ticker_list) - len(due_tickers))
+    ticker_list = due_tickers
+
+    try:
+        last_dates = fetch_last_dates(engine)
+    except Exception as e:
+        logging.error("Failed to read latest stored dates: %s", e)
+        return
+
+    # Bucket tickers by start date so each batch can share one download request
+    buckets = defaultdict(list)
+    for ticker in ticker_list:
+        buckets[get_start_date(last_dates, ticker)].append(ticker)
+
+    batches = [
+        (start_date, tickers[i:i + DOWNLOAD_BATCH_SIZE])
+        for start_date, tickers in buckets.items()
+        for i in range(0, len(tickers), DOWNLOAD_BATCH_SIZE)
+    ]
+
+    # yf.download keeps module-level state, so downloads stay sequential (each one is
+    # already threaded internally); DB writes run on a thread pool and overlap with
+    # the next batch's download. At most WRITE_WORKERS writes are pending at a time, so
+    # downloads cannot run ahead and pile up batches in memory.
+    pending = set()
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+        for start_date, batch in tqdm(batches, desc="Fetching Historical Data to DB"):
+            try:
+                df_batch = yf.download(
+                    batch,
+                    start=start_date,
+                    actions=True,
+                    auto_adjust=True,
+                    threads=True,
+                    group_by='ticker',
+                    ignore_tz=True,
+                    progress=False,
+                )
+            except Exception as e:
+                logging.error("Failed to download batch of %d tickers starting %s: %s", len(batch), start_date, e)
                 continue
 
-            df_new.reset_index(inplace=True)
-            # Ensure correct data types for DB
-            df_new['Date'] = pd.to_datetime(df_new['Date']).dt.date
-            for col in ['Open', 'High', 'Low', 'Close', 'Volume']:
-                if col in df_new.columns:
-                    df_new[col] = pd.to_numeric(df_new[col])
+            frames = {}
+            empty_watermarks = []
+            for ticker in batch:
+                try:
+                    df_new = extract_ticker_data(df_batch, ticker)
+                except Exception as e:
+                    logging.error("[%s] Failed to process ticker: %s", ticker, e)
+                    continue
 
-            # Write to database
-            df_new.to_sql(table_name, con=engine, if_exists='append', index=False)
-            logging.info("[%s] Saved/Appended %d records to table `%s`.", ticker, len(df_new), table_name)
+                if df_new.empty:
+                    logging.info("[%s] No new data available since %s.", ticker, start_date)
+                    empty_watermarks.append(
+                        {'ticker': ticker, 'last_date': None, 'next_earliest_fetch': get_next_fetch_time(None)}
+                    )
+                    continue
 
-        except Exception as e:
-            logging.error("[%s] Failed to process ticker: %s", ticker, e)
+                frames[ticker] = df_new
+
+            if frames:
+                if len(pending) >= WRITE_WORKERS:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(executor.submit(save_batch_data, engine, frames))
+
+            # Back off tickers with no new data so frequent triggers don't re-request them
+            try:
+                update_watermarks(engine, empty_watermarks)
+            except Exception as e:
+                logging.error("Failed to update watermarks for %d tickers: %s", len(empty_watermarks), e)
 
 
 def run_data_collection():
@@ -154,6 +499,8 @@ def run_data_collection():
             tickers_to_fetch = fetch_all_tickers()
 
         if tickers_to_fetch:
+            ensure_prices_table(db_engine)
+            migrate_legacy_tables(db_engine, tickers_to_fetch)
             fetch_historical_data(db_engine, tickers_to_fetch)
             logging.info("歷史數據抓取流程完成。")
         else: